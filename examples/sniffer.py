@@ -6,8 +6,6 @@ To run this example as a script, the following command:
 $ python -m example.sniffer sf@location:port
 ```
 """
-from __future__ import print_function
-
 from argparse import ArgumentParser
 from functools import partial
 import logging
@@ -59,7 +57,7 @@ def construct_connection(connection_string):
     # _must_ take exactly 1 positional argument. That argument will be an instance of
     # `moteconnection.message.Message`.
     # The alternatice method to using a callback function is to pass an instance of
-    # `queue.Queue` (python3) or `Queue.Queue` (python2) to these methoods.
+    # `queue.Queue` to these methoods.
     dispatcher.register_default_snooper(print)
     dispatcher.register_default_receiver(print)
     connection.register_dispatcher(dispatcher)
@@ -1,11 +1,10 @@
 """connection.py: Connection for connecting to serial or sf ports."""
 
+import collections
 import logging
+import queue
 import threading
 import time
-from codecs import encode
-
-from six.moves import queue
 
 from moteconnection.connection_events import ConnectionEvents
 from moteconnection.connection_forwarder import SfConnection
@@ -32,15 +31,49 @@ class ConnectionException(Exception):
     pass
 
 
+class EventMailbox(object):
+    """
+    Event queue between the real connections and the Connection thread.
+    Any thread may put, only the Connection thread waits and drains.
+    """
+
+    def __init__(self):
+        self._items = collections.deque()  # append and popleft are thread-safe
+        self._ready = threading.Event()
+
+    def put(self, item):
+        self._items.append(item)
+        self._ready.set()
+
+    def wait(self, timeout=None):
+        """
+        :param timeout: Seconds to wait, None waits until an item is put.
+        :return: True if there are items to drain.
+        """
+        self._ready.clear()
+        if self._items:
+            return True
+        return self._ready.wait(timeout)
+
+    def drain(self):
+        items = self._items
+        while items:
+            yield items.popleft()
+
+
 class Connection(threading.Thread):
 
     def __init__(self, autostart=True):
         super(Connection, self).__init__()
         self._dispatchers = {}
+        # Bound dispatcher methods, receive handlers are indexed by the dispatch byte
+        self._send_handlers = {}
+        self._receive_handlers = [None] * 256
 
         self._real_connection = None
 
         self._last_connect = 0
+        self._reconnect_deadline = None
 
         self._connection_type = None
         self._connection_info = None
@@ -52,41 +85,58 @@ class Connection(threading.Thread):
         # New connection types can be added here
         self.connection_types = {"loopback": LoopbackConnection, "sf": SfConnection, "serial": SerialConnection}
 
-        self._queue = queue.Queue()
+        self._queue = EventMailbox()
+        self._handlers = [None] * len(ConnectionEvents)
+        self._handlers[ConnectionEvents.MESSAGE_INCOMING] = self._handle_incoming
+        self._handlers[ConnectionEvents.MESSAGE_OUTGOING] = self._handle_outgoing
+        self._handlers[ConnectionEvents.EVENT_START_CONNECT] = self._handle_start_connect
+        self._handlers[ConnectionEvents.EVENT_CONNECTED] = self._handle_connected
+        self._handlers[ConnectionEvents.EVENT_DISCONNECTED] = self._handle_disconnected
+        self._handlers[ConnectionEvents.EVENT_SHUTDOWN] = self._handle_shutdown
 
         # Can be connected, disconnected or somewhere in between
         self._connected = threading.Event()
         self._connected.clear()
         self._disconnected = threading.Event()
         self._disconnected.set()
+        # Plain copies of the connection state for checks that do not wait
+        self._is_connected = False
+        self._is_disconnected = True
 
-        self._alive = threading.Event()
-        self._alive.set()
+        self._is_alive = True
 
         if autostart:
             self.start()
 
     def join(self, timeout=None):
-        self._alive.clear()
+        self._is_alive = False
+        self._queue.put((ConnectionEvents.EVENT_SHUTDOWN, None))
         if self._real_connection is not None:
             self._real_connection.join(timeout)
         threading.Thread.join(self, timeout)
 
     def send(self, packet):
-        if packet.dispatch in self._dispatchers:
-            self._dispatchers[packet.dispatch].send(packet)
+        handler = self._send_handlers.get(packet.dispatch)
+        if handler is not None:
+            handler(packet)
         else:
             raise DispatcherError("No dispatcher for sending {:02X}".format(packet.dispatch))
 
     def register_dispatcher(self, dispatcher):
         self.remove_dispatcher(dispatcher.dispatch)
         self._dispatchers[dispatcher.dispatch] = dispatcher
+        self._send_handlers[dispatcher.dispatch] = dispatcher.send
+        if 0 <= dispatcher.dispatch <= 0xFF:
+            self._receive_handlers[dispatcher.dispatch] = dispatcher.receive
         dispatcher.attach(self._subsend)
 
     def remove_dispatcher(self, dispatch):
         if dispatch in self._dispatchers:
             self._dispatchers[dispatch].detach()
             del self._dispatchers[dispatch]
+            del self._send_handlers[dispatch]
+            if 0 <= dispatch <= 0xFF:
+                self._receive_handlers[dispatch] = None
 
     def retrieve_dispatcher(self, dispatch):
         if dispatch in self._dispatchers:
@@ -94,7 +144,7 @@ class Connection(threading.Thread):
         return None
 
     def connected(self):
-        return self._connected.isSet() and not self._disconnected.isSet()
+        return self._is_connected
 
     def connect(self, connection_string, reconnect=None, connected=None, disconnected=None):
         """
@@ -104,7 +154,7 @@ class Connection(threading.Thread):
         :param disconnected: Optional callback for receiving disconnection notifications.
         :return:
         """
-        if self._connected.isSet() is False and self._disconnected.isSet():
+        if not self._is_connected and self._is_disconnected:
             log.debug("connect")
             conntype, conninfo = split_in_two(connection_string, "@")
             if conntype in self.connection_types:
@@ -115,6 +165,7 @@ class Connection(threading.Thread):
                 self._event_connected = connected
                 self._event_disconnected = disconnected
 
+                self._is_disconnected = False
                 self._disconnected.clear()
                 self._queue.put((ConnectionEvents.EVENT_START_CONNECT, None))
             else:
@@ -124,6 +175,7 @@ class Connection(threading.Thread):
 
     def disconnect(self):
         self._reconnect_period = None
+        self._reconnect_deadline = None
         log.debug("disconnect")
 
         while not self._connected.is_set() and not self._disconnected.is_set():  # Connecting
@@ -144,50 +196,78 @@ class Connection(threading.Thread):
 
     def _receive(self, data):
         if len(data) > 0:
-            dispatch = ord(data[0:1])
-            if dispatch in self._dispatchers:
-                self._dispatchers[dispatch].receive(data)
+            dispatch = data[0]
+            handler = self._receive_handlers[dispatch]
+            if handler is not None:
+                handler(data)
             else:
                 log.debug("No dispatcher for receiving %02X", dispatch)
         else:
             log.debug("Received 0 bytes of data ...")
 
+    def _reconnect_timeout(self):
+        """
+        :return: Seconds until the next reconnect attempt or None if no attempt is scheduled.
+        """
+        if self._is_disconnected and self._reconnect_deadline is not None:
+            return max(0, self._reconnect_deadline - time.monotonic())
+        return None
+
+    def _handle_incoming(self, data):
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("incoming %s", data.hex())
+        self._receive(data)
+
+    def _handle_outgoing(self, packet):
+        log.debug("outgoing %s", packet)
+        self._real_connection.send(packet)
+
+    def _handle_connected(self, _):
+        log.info("connected")
+        self._is_connected = True
+        self._is_disconnected = False
+        self._connected.set()
+        self._disconnected.clear()
+        if callable(self._event_connected):
+            self._event_connected()
+
+    def _handle_disconnected(self, _):
+        log.info("disconnected")
+        self._is_connected = False
+        self._is_disconnected = True
+        self._connected.clear()
+        self._disconnected.set()
+        if callable(self._event_disconnected):
+            self._event_disconnected()
+
+    def _handle_start_connect(self, _):
+        self._connect()
+
+    def _handle_shutdown(self, _):
+        pass  # only wakes up the run loop
+
     def run(self):
-        while self._alive.isSet():
-            try:
-                item_type, item = self._queue.get(True, 1.0)
-                if item_type == ConnectionEvents.MESSAGE_INCOMING:
-                    log.debug("incoming %s", encode(item, "hex"))
-                    self._receive(item)
-                elif item_type == ConnectionEvents.MESSAGE_OUTGOING:
-                    log.debug("outgoing %s", item)
-                    self._real_connection.send(item)
-                elif item_type == ConnectionEvents.EVENT_CONNECTED:
-                    log.info("connected")
-                    self._connected.set()
-                    self._disconnected.clear()
-                    if callable(self._event_connected):
-                        self._event_connected()
-                elif item_type == ConnectionEvents.EVENT_DISCONNECTED:
-                    log.info("disconnected")
-                    self._connected.clear()
-                    self._disconnected.set()
-                    if callable(self._event_disconnected):
-                        self._event_disconnected()
-                elif item_type == ConnectionEvents.EVENT_START_CONNECT:
-                    self._connect()
-                else:
-                    raise Exception("item_type is unknown!")
-            except queue.Empty:
-                if self._disconnected.isSet():
-                    if self._reconnect_period is not None and self._reconnect_period >= 0:
-                        if time.time() > self._last_connect + self._reconnect_period:
-                            self._queue.put((ConnectionEvents.EVENT_START_CONNECT, None))
-                continue
+        handlers = self._handlers
+        while self._is_alive:
+            if self._queue.wait(self._reconnect_timeout()):
+                for item_type, item in self._queue.drain():  # Everything queued before blocking again
+                    try:
+                        handler = handlers[item_type]
+                    except (IndexError, TypeError):
+                        raise Exception("item_type is unknown!")
+                    handler(item)
+            elif self._reconnect_timeout() == 0:
+                self._queue.put((ConnectionEvents.EVENT_START_CONNECT, None))
 
     def _connect(self):
-        self._last_connect = time.time()
+        self._last_connect = time.monotonic()
+        if self._reconnect_period is not None and self._reconnect_period >= 0:
+            self._reconnect_deadline = self._last_connect + self._reconnect_period
+        else:
+            self._reconnect_deadline = None
         self._real_connection = self.connection_types[self._connection_type](self._queue, self._connection_info)
+        if isinstance(self._real_connection, LoopbackConnection):
+            self._real_connection.attach(self._handle_incoming)
 
 
 class Dispatcher(object):
@@ -201,11 +281,20 @@ class Dispatcher(object):
         return self._dispatch
 
     @staticmethod
-    def _deliver(receiver, message):
+    def _delivery(receiver):
+        """
+        Resolve how messages reach a receiver, done once when it is registered.
+        :param receiver: queue.Queue, callable taking a message or None.
+        :return: Callable taking a message or None.
+        """
         if isinstance(receiver, queue.Queue):
-            receiver.put(message)
-        else:
-            receiver(message)
+            return receiver.put
+        return receiver
+
+    @staticmethod
+    def _deliver(receiver, message):
+        """For subclasses that resolve the receiver per message, the dispatchers here use _delivery."""
+        Dispatcher._delivery(receiver)(message)
 
     def attach(self, sender):
         self._sender = sender
@@ -226,14 +315,29 @@ class LoopbackConnection(threading.Thread):
         super(LoopbackConnection, self).__init__()
         self._queue = event_queue
         self._info = info
+        self._receive = None
         self.start()
 
+    def attach(self, receive):
+        """
+        Deliver sent data directly to receive instead of going through the event queue.
+        :param receive: Called with the serialized packet, on the thread that calls send.
+        """
+        self._receive = receive
+
     def join(self, timeout=None):
         self._queue.put((ConnectionEvents.EVENT_DISCONNECTED, None))
         threading.Thread.join(self, timeout)
 
-    def send(self, data):
-        self._queue.put((ConnectionEvents.MESSAGE_INCOMING, data))
+    def send(self, packet):
+        data = packet.serialize()
+        if self._receive is not None:
+            self._receive(data)
+        else:
+            self._queue.put((ConnectionEvents.MESSAGE_INCOMING, data))
+
+        if packet.callback:
+            packet.callback(packet, True)
 
     def run(self):
         self._queue.put((ConnectionEvents.EVENT_CONNECTED, None))
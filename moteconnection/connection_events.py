@@ -1,15 +1,17 @@
 """connection_events.py: Connection event types."""
 
-from enum import Enum
+from enum import IntEnum
 
 
 __author__ = "Raido Pahtma"
 __license__ = "MIT"
 
 
-class ConnectionEvents(Enum):
+class ConnectionEvents(IntEnum):
+    # Values are contiguous, they index the event handler table of Connection
     MESSAGE_INCOMING = 0
     MESSAGE_OUTGOING = 1
-    EVENT_START_CONNECT = 3
-    EVENT_CONNECTED = 4
-    EVENT_DISCONNECTED = 5
+    EVENT_START_CONNECT = 2
+    EVENT_CONNECTED = 3
+    EVENT_DISCONNECTED = 4
+    EVENT_SHUTDOWN = 5
@@ -1,11 +1,13 @@
 """"connection_forwarder.py: SF connection object."""
 
+import collections
+import errno
 import logging
+import os
+import selectors
 import socket
+import struct
 import threading
-from codecs import encode
-
-from six import BytesIO
 
 from moteconnection.connection_events import ConnectionEvents
 from moteconnection.utils import split_in_two
@@ -18,15 +20,93 @@ __author__ = "Raido Pahtma"
 __license__ = "MIT"
 
 
-class SfConnection(threading.Thread):
+class SfReactor(threading.Thread):
+    """
+    Services the sockets of all SfConnections from a single thread.
+    The selector is only touched from the reactor thread, other threads hand work over with call.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        super(SfReactor, self).__init__(name="SfReactor")
+        self.daemon = True
+
+        self._selector = selectors.DefaultSelector()
+        self._calls = collections.deque()
+
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
+
+        self.start()
+
+    @classmethod
+    def instance(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = SfReactor()
+            return cls._instance
+
+    def call(self, function, *args):
+        """Run function(*args) on the reactor thread."""
+        self._calls.append((function, args))
+        self._wake_w.send(b"\x00")
+
+    def register(self, sock, events, callback):
+        self._selector.register(sock, events, callback)
+
+    def modify(self, sock, events, callback):
+        self._selector.modify(sock, events, callback)
+
+    def unregister(self, sock):
+        try:
+            self._selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass  # never registered or already closed
+
+    def _run_calls(self):
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except socket.error:
+            pass  # all wakeups consumed
+
+        while self._calls:
+            function, args = self._calls.popleft()
+            function(*args)
+
+    def run(self):
+        while True:
+            for key, mask in self._selector.select():
+                try:
+                    if key.fileobj is self._wake_r:
+                        self._run_calls()
+                    else:
+                        key.data(mask)
+                except Exception:
+                    log.exception("SfReactor callback failed")
+
+
+class SfConnection(object):
 
     PROTOCOL_VERSION = b"U "
+    RECEIVE_BUFFER_SIZE = 65536
+    SOCKET_RCVBUF = 1 << 20  # None leaves the OS default
+    SOCKET_SNDBUF = 1 << 20  # None leaves the OS default
+    SEND_TIMEOUT = 1.0  # seconds, a peer that stops reading for longer is disconnected
 
     def __init__(self, event_queue, host_and_port):
-        super(SfConnection, self).__init__()
         self._queue = event_queue
 
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if self.SOCKET_RCVBUF is not None:
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.SOCKET_RCVBUF)
+        if self.SOCKET_SNDBUF is not None:
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.SOCKET_SNDBUF)
 
         host, port = split_in_two(host_and_port, ":")
         if len(port) > 0:
@@ -36,102 +116,152 @@ class SfConnection(threading.Thread):
 
         self._server_address = (host, port)
 
-        self._alive = threading.Event()
-        self._alive.set()
+        self._connected = False
 
-        self._connected = threading.Event()
-        self._connected.clear()
+        self._closed = threading.Event()
+        self._closed.clear()
 
-        self._recv_length = 0
-        self._recv_buf = None
+        self._rx = bytearray(self.RECEIVE_BUFFER_SIZE)
+        self._rx_view = memoryview(self._rx)
+        self._rx_filled = 0
 
-        self.start()
+        self._reactor = SfReactor.instance()
+        self._reactor.call(self._connect)
 
     def send(self, packet):
         data = packet.serialize()
         acked = False
-        if self._connected.isSet():
+        if len(data) > 0xFF:
+            log.error("packet too long for a serial forwarder frame: %d > 255", len(data))
+        elif self._connected:
             try:
-                self._socket.sendall(chr(len(data)).encode())
-                self._socket.sendall(data)
+                self._socket.sendall(struct.pack("!B", len(data)) + data)
                 acked = True
-                log.debug("snt %s", encode(data, "hex"))
-            except socket.error:
-                self._disconnected()
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug("snt %s", data.hex())
+            except socket.error as e:
+                log.error("socket.error: %s", e.args)
+                self._connected = False  # drop whatever is queued instead of timing out on each
+                self._reactor.call(self._disconnected)
         else:
-            log.debug("drop %s", encode(data, "hex"))
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("drop %s", data.hex())
 
         if packet.callback:
             packet.callback(packet, acked)
 
     def join(self, timeout=None):
-        self._alive.clear()
-        self._socket.close()
-        threading.Thread.join(self, timeout)
+        self._reactor.call(self._disconnected)
+        self._closed.wait(timeout)
 
     def _disconnected(self):
+        if self._closed.is_set():
+            return
         log.debug("disconnected")
-        self._connected.clear()
+        self._reactor.unregister(self._socket)
+        self._connected = False
         self._queue.put((ConnectionEvents.EVENT_DISCONNECTED, None))
         self._socket.close()
+        self._closed.set()
 
     def _connect(self):
-        self._socket.connect(self._server_address)
-
-        log.debug("socket connected")
+        if self._closed.is_set():
+            return  # joined before the reactor got to it
+        try:
+            self._socket.setblocking(False)
+            err = self._socket.connect_ex(self._server_address)
+            if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                raise socket.error(err, os.strerror(err))
+            self._reactor.register(self._socket, selectors.EVENT_WRITE, self._on_connect)
+        except socket.error as e:
+            log.error("socket.error: %s", e.args)
+            self._disconnected()
 
-        self._socket.sendall(self.PROTOCOL_VERSION)
-        log.debug("handshake sent")
+    def _on_connect(self, _):
+        try:
+            err = self._socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err != 0:
+                raise socket.error(err, os.strerror(err))
 
-        buf = BytesIO()
-        while len(buf.getvalue()) < 2:
-            data = self._socket.recv(2 - len(buf.getvalue()))
-            if data:
-                buf.write(data)
-            else:
-                raise socket.error("no data received")
+            # The selector reports readiness, so receives return immediately, sends may wait for the peer
+            self._socket.settimeout(self.SEND_TIMEOUT)
+            log.debug("socket connected")
 
-        if buf.getvalue() == b"U ":
-            log.debug("handshake success")
-            self._connected.set()
-            self._queue.put((ConnectionEvents.EVENT_CONNECTED, None))
-        else:
-            raise socket.error("handshake mismatch {!s} != {!s}".format(self.PROTOCOL_VERSION, buf.getvalue()))
+            self._socket.sendall(self.PROTOCOL_VERSION)
+            log.debug("handshake sent")
 
-    def _receive(self):
-        try:
-            if self._recv_length == 0:
-                length = self._socket.recv(1)
-                if length:
-                    self._recv_length = ord(length)
-                    self._recv_buf = BytesIO()
-                else:
-                    raise socket.error("no data received")
-            else:
-                data = self._socket.recv(self._recv_length - len(self._recv_buf.getvalue()))
-                if data:
-                    self._recv_buf.write(data)
-                    if self._recv_length == len(self._recv_buf.getvalue()):
-                        log.debug("rcv %s", encode(self._recv_buf.getvalue(), "hex"))
-                        self._recv_length = 0
-                        return self._recv_buf.getvalue()
-                else:
-                    raise socket.error("no data received")
-
-        except socket.timeout:
-            pass  # timeouts are normal
-
-        return None
+            self._reactor.modify(self._socket, selectors.EVENT_READ, self._on_readable)
+        except socket.error as e:
+            log.error("socket.error: %s", e.args)
+            self._disconnected()
 
-    def run(self):
+    def _on_readable(self, _):
         try:
-            self._connect()
-            self._socket.settimeout(0.1)
-            while self._alive.isSet():
-                data = self._receive()
-                if data is not None:
-                    self._queue.put((ConnectionEvents.MESSAGE_INCOMING, data))
+            for data in self._receive():
+                self._queue.put((ConnectionEvents.MESSAGE_INCOMING, data))
         except socket.error as e:
             log.error("socket.error: %s", e.args)
-        finally:
             self._disconnected()
+
+    def _discard(self, count):
+        remaining = self._rx_filled - count
+        self._rx[:remaining] = self._rx[count:self._rx_filled]
+        self._rx_filled = remaining
+
+    def _handshake(self):
+        """
+        Check the protocol version the server sent back.
+        :return: True if the handshake has been completed.
+        """
+        if self._rx_filled < len(self.PROTOCOL_VERSION):
+            return False
+
+        handshake = bytes(self._rx_view[:len(self.PROTOCOL_VERSION)])
+        self._discard(len(self.PROTOCOL_VERSION))
+        if handshake == self.PROTOCOL_VERSION:
+            log.debug("handshake success")
+            self._connected = True
+            self._queue.put((ConnectionEvents.EVENT_CONNECTED, None))
+            return True
+
+        raise socket.error("handshake mismatch {!s} != {!s}".format(self.PROTOCOL_VERSION, handshake))
+
+    def _extract_frames(self):
+        """
+        Take all complete length-prefixed frames out of the receive buffer.
+        :return: List of frame payloads, partial frame data stays in the buffer.
+        """
+        rx = self._rx
+        rx_view = self._rx_view
+        filled = self._rx_filled
+
+        frames = []
+        start = 0
+        while start < filled:
+            end = start + 1 + rx[start]
+            if end > filled:
+                break
+            frames.append(bytes(rx_view[start + 1:end]))
+            start = end
+
+        if start > 0:
+            self._discard(start)
+
+        if log.isEnabledFor(logging.DEBUG):
+            for data in frames:
+                log.debug("rcv %s", data.hex())
+        return frames
+
+    def _receive(self):
+        """
+        Read everything the socket has available and split it into frames.
+        :return: List of complete frames, partial frame data stays in the buffer.
+        """
+        n = self._socket.recv_into(self._rx_view[self._rx_filled:])
+        if n == 0:
+            raise socket.error("no data received")
+        self._rx_filled += n
+
+        if self._connected or self._handshake():
+            return self._extract_frames()
+        return []
@@ -1,14 +1,15 @@
 """"connection_serial.py: Serial connection object."""
 
+import binascii
 import logging
+import queue
+import selectors
+import socket
 import struct
 import threading
 import time
-from codecs import encode
 
 import serial
-from six import BytesIO
-from six.moves import queue
 
 from moteconnection.connection_events import ConnectionEvents
 from moteconnection.utils import split_in_two
@@ -22,16 +23,8 @@ __license__ = "MIT"
 
 
 def itut_g16_crc(data):
-    crc = 0
-    for p in range(len(data)):
-        crc ^= ord(data[p:p+1]) << 8
-        for _ in range(0, 8):
-            if crc & 0x8000 != 0:
-                crc = (crc << 1) ^ 0x1021
-            else:
-                crc <<= 1
-            crc &= 0xFFFF
-    return crc
+    """CRC-CCITT with polynomial 0x1021 and initial value 0, computed by binascii in C."""
+    return binascii.crc_hqx(data, 0)
 
 
 class SerialPacketException(Exception):
@@ -40,12 +33,18 @@ class SerialPacketException(Exception):
 
 class SerialConnection(threading.Thread):
 
-    HDLC_FRAMING_BYTE = b'\x7e'
-    HDLC_ESCAPE_BYTE = b'\x7d'
-    HDLC_XOR_BYTE = b'\x20'
-    SERIAL_PROTOCOL_ACK = b'\x43'
-    SERIAL_PROTOCOL_PACKET = b'\x44'
-    SERIAL_PROTOCOL_NO_ACK_PACKET = b'\x45'
+    HDLC_FRAMING_BYTE = 0x7E
+    HDLC_ESCAPE_BYTE = 0x7D
+    HDLC_XOR_BYTE = 0x20
+    SERIAL_PROTOCOL_ACK = 0x43
+    SERIAL_PROTOCOL_PACKET = 0x44
+    SERIAL_PROTOCOL_NO_ACK_PACKET = 0x45
+
+    # HDLC bytes and their escape sequences as byte strings, for escaping whole frames at once
+    _HDLC_FRAMING = bytes((HDLC_FRAMING_BYTE,))
+    _HDLC_ESCAPE = bytes((HDLC_ESCAPE_BYTE,))
+    _HDLC_ESCAPED_FRAMING = bytes((HDLC_ESCAPE_BYTE, HDLC_FRAMING_BYTE ^ HDLC_XOR_BYTE))
+    _HDLC_ESCAPED_ESCAPE = bytes((HDLC_ESCAPE_BYTE, HDLC_ESCAPE_BYTE ^ HDLC_XOR_BYTE))
     SERIAL_ACK_TIMEOUT = 0.2
     SERIAL_PORT_TIMEOUT = 0.01
     SERIAL_SEND_TRIES = 1
@@ -73,40 +72,105 @@ class SerialConnection(threading.Thread):
             else:
                 log.warning("Unrecognized ACK configuration '%s'", acks)
 
-        self._alive = threading.Event()
-        self._alive.set()
+        self._alive = True
 
-        self._connected = threading.Event()
-        self._connected.clear()
+        self._connected = False
 
         if require_acks:
             self._seq_out = 0
         else:
             self._seq_out = None
         self._seq_in = None
+        self._ack_frames = [None] * 256
 
         self._outqueue = queue.Queue()
+        self._selector = None
+        self._wake_r = None
+        self._wake_w = None
         self._recv_length = 0
         self._recv_buf = None
 
         self.start()
 
     def send(self, packet):
-        if self._connected.isSet():
+        if self._connected:
             log.debug("snd %s", packet)
             self._outqueue.put(packet)
+            self._wakeup()
         else:
             log.debug("drop %s", packet)
 
     def join(self, timeout=None):
-        self._alive.clear()
-        if self._serial_port is not None:
-            self._serial_port.close()
+        self._alive = False
+        self._wakeup()  # run closes the port once it wakes up or its read times out
         threading.Thread.join(self, timeout)
 
+    def _wakeup(self):
+        if self._wake_w is not None:
+            try:
+                self._wake_w.send(b"\x00")
+            except OSError:
+                pass  # wakeup already pending or run has finished
+
+    def _open_selector(self):
+        """
+        Wait on the serial port and a wakeup socket instead of polling with a read timeout.
+        Not possible on Windows, where the port has no file descriptor, reads then keep polling.
+        """
+        try:
+            fileno = self._serial_port.fileno()
+        except (AttributeError, OSError):
+            return
+        if not isinstance(fileno, int):
+            return  # not backed by a file descriptor
+
+        # kqueue and poll do not support tty devices on macOS, select does
+        selector = selectors.SelectSelector()
+        wake_r, wake_w = socket.socketpair()
+        try:
+            selector.register(fileno, selectors.EVENT_READ)
+            selector.register(wake_r, selectors.EVENT_READ)
+        except (OSError, ValueError) as e:
+            log.debug("polling the serial port, it can not be selected: %s", e.args)
+            selector.close()
+            wake_r.close()
+            wake_w.close()
+            return
+
+        wake_r.setblocking(False)
+        wake_w.setblocking(False)
+        self._serial_port.timeout = 0
+        self._selector = selector
+        self._wake_r, self._wake_w = wake_r, wake_w
+
+    def _close_selector(self):
+        if self._selector is not None:
+            self._selector.close()
+            self._wake_w.close()
+            self._wake_r.close()
+            self._selector = None
+
+    def _read(self, timeout):
+        """
+        :param timeout: Seconds to wait for data or a wakeup, None waits until either arrives.
+        :return: Data read from the serial port, empty if woken up or timed out.
+        """
+        if self._selector is not None:
+            ready = [key.fileobj for key, _ in self._selector.select(timeout)]
+            if any(fileobj is not self._wake_r for fileobj in ready):
+                return self._serial_port.read(max(1, self._serial_port.in_waiting))
+            # Wakeups are consumed only once nothing is left to read, the outqueue is checked after that
+            try:
+                while self._wake_r.recv(4096):
+                    pass
+            except OSError:
+                pass  # all wakeups consumed
+            return b""
+        return self._serial_port.read(max(1, self._serial_port.in_waiting))
+
     def _disconnected(self):
         log.debug("disconnected")
-        self._connected.clear()
+        self._connected = False
         self._queue.put((ConnectionEvents.EVENT_DISCONNECTED, None))
 
     def _process_incoming_packet(self, data):
@@ -115,34 +179,32 @@ class SerialConnection(threading.Thread):
         :param bytes data:
         :return:
         """
-        log.debug("recv %s", encode(data, "hex"))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("recv %s", data.hex())
         if len(data) > 2:
-            packet_data = data[:-2]
-            lcrc = ord(data[-2:-1])
-            mcrc = ord(data[-1:])
-            packet_crc = (mcrc << 8) + lcrc
-            crc = itut_g16_crc(packet_data)
+            packet_crc = (data[-1] << 8) + data[-2]
+            crc = itut_g16_crc(memoryview(data)[:-2])
             if crc != packet_crc:
                 raise SerialPacketException("crc mismatch {:04X} != {:04X}".format(crc, packet_crc))
 
-            if len(packet_data) > 0:
-                packet_protocol = data[0:1]    # python3 compatibility trick
-                packet_data = packet_data[1:]
+            packet_length = len(data) - 3  # Without the protocol byte and the crc
+            if packet_length >= 0:
+                packet_protocol = data[0]
 
                 if packet_protocol == self.SERIAL_PROTOCOL_ACK:
-                    if len(packet_data) > 0:
-                        return ord(packet_data[0:1]), None
+                    if packet_length > 0:
+                        return data[1], None
                     else:
                         raise SerialPacketException("not enough data for SERIAL_PROTOCOL_ACK")
 
                 if packet_protocol == self.SERIAL_PROTOCOL_PACKET:
-                    if len(packet_data) > 1:
-                        return ord(packet_data[0:1]), packet_data[1:]
+                    if packet_length > 1:
+                        return data[1], data[2:-2]
                     else:
                         raise SerialPacketException("not enough data for SERIAL_PROTOCOL_PACKET")
 
                 elif packet_protocol == self.SERIAL_PROTOCOL_NO_ACK_PACKET:
-                    return None, packet_data
+                    return None, data[1:-2]
 
                 else:
                     raise SerialPacketException("unknown serial packet protocol {:02X}".format(packet_protocol))
@@ -151,35 +213,46 @@ class SerialConnection(threading.Thread):
         else:
             raise SerialPacketException("not enough data for serial protocols")
 
+    def _unescape(self, frame):
+        """
+        :param frame: HDLC frame contents without the framing bytes.
+        :return: bytes with escape sequences replaced by the original bytes.
+        """
+        # Framing bytes go first, an escaped escape byte followed by 5E must not become a framing byte
+        frame = bytes(frame).replace(self._HDLC_ESCAPED_FRAMING, self._HDLC_FRAMING)
+        return frame.replace(self._HDLC_ESCAPED_ESCAPE, self._HDLC_ESCAPE)
+
+    def _frame(self, data):
+        """
+        :param bytearray data: Protocol byte, sequence number and payload.
+        :return: bytes with the crc appended, escaped and enclosed in framing bytes.
+        """
+        data += struct.pack("<H", itut_g16_crc(data))
+
+        # Escape bytes go first, otherwise the escape bytes added for framing bytes would be escaped again
+        body = data.replace(self._HDLC_ESCAPE, self._HDLC_ESCAPED_ESCAPE)
+        body = body.replace(self._HDLC_FRAMING, self._HDLC_ESCAPED_FRAMING)
+        return self._HDLC_FRAMING + body + self._HDLC_FRAMING
+
     def _write(self, seq, packet):
-        data = BytesIO()
-        if seq is None:
-            data.write(self.SERIAL_PROTOCOL_NO_ACK_PACKET)
+        if seq is not None and packet is None:
+            # An ack only depends on the sequence number, so every ack frame is built once
+            escaped = self._ack_frames[seq]
+            if escaped is None:
+                escaped = self._ack_frames[seq] = self._frame(bytearray((self.SERIAL_PROTOCOL_ACK, seq)))
         else:
-            if packet is None:
-                data.write(self.SERIAL_PROTOCOL_ACK)
-            else:
-                data.write(self.SERIAL_PROTOCOL_PACKET)
-            data.write(chr(seq).encode())
-        # Python3 does not allow writing 'None' to BytesIO
-        if packet is not None:
-            data.write(packet)
-        data.write(struct.pack("<H", itut_g16_crc(data.getvalue())))
-
-        escaped = BytesIO()
-        escaped.write(self.HDLC_FRAMING_BYTE)
-        datavalue = data.getvalue()
-        for i in range(len(datavalue)):
-            obyte = datavalue[i:i+1]
-            if obyte == self.HDLC_ESCAPE_BYTE or obyte == self.HDLC_FRAMING_BYTE:
-                escaped.write(self.HDLC_ESCAPE_BYTE)
-                escaped.write(encode(chr(ord(obyte) ^ ord(self.HDLC_XOR_BYTE))))
+            data = bytearray()
+            if seq is None:
+                data.append(self.SERIAL_PROTOCOL_NO_ACK_PACKET)
             else:
-                escaped.write(obyte)
-        escaped.write(self.HDLC_FRAMING_BYTE)
+                data.append(self.SERIAL_PROTOCOL_PACKET)
+                data.append(seq)
+            data += packet
+            escaped = self._frame(data)
 
-        log.debug("write %s", encode(escaped.getvalue(), "hex"))
-        self._serial_port.write(escaped.getvalue())
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("write %s", escaped.hex())
+        self._serial_port.write(escaped)
 
     def run(self):
         try:
@@ -189,8 +262,9 @@ class SerialConnection(threading.Thread):
                                               timeout=self.SERIAL_PORT_TIMEOUT)
 
             self._serial_port.flushInput()
+            self._open_selector()
 
-            self._connected.set()
+            self._connected = True
             self._queue.put((ConnectionEvents.EVENT_CONNECTED, None))
             log.debug("connected")
 
@@ -199,17 +273,24 @@ class SerialConnection(threading.Thread):
             timestamp = None
             tries = 0
 
-            recv_buf = BytesIO()
-            escape = False
+            recv_buf = bytearray()
 
-            while self._alive.isSet():
-                data = self._serial_port.read()
+            while self._alive:
+                if outgoing is not None:
+                    timeout = max(0, timestamp + self.SERIAL_ACK_TIMEOUT - time.time())
+                elif not self._outqueue.empty():
+                    timeout = 0  # Wakeups for queued packets have already been consumed
+                else:
+                    timeout = None
+                data = self._read(timeout)
                 if len(data) > 0:
-                    # log.debug("rcv %02X", data)
-                    if data == self.HDLC_FRAMING_BYTE:
-                        if len(recv_buf.getvalue()) > 0:
+                    recv_buf += data
+                    frames = recv_buf.split(self._HDLC_FRAMING)
+                    recv_buf = frames.pop()  # Not terminated by a framing byte yet
+                    for frame in frames:
+                        if len(frame) > 0:
                             try:
-                                seq, packet = self._process_incoming_packet(recv_buf.getvalue())
+                                seq, packet = self._process_incoming_packet(self._unescape(frame))
                                 if seq is None:
                                     if packet is not None:
                                         self._queue.put((ConnectionEvents.MESSAGE_INCOMING, packet))
@@ -240,16 +321,6 @@ class SerialConnection(threading.Thread):
 
                             except SerialPacketException as e:
                                 log.warning(e.args[0])
-                            finally:
-                                recv_buf = BytesIO()
-
-                    elif data == self.HDLC_ESCAPE_BYTE:
-                        escape = True
-                    else:
-                        if escape:
-                            escape = False
-                            data = encode(chr(ord(data[0:1]) ^ ord(self.HDLC_XOR_BYTE)))
-                        recv_buf.write(data)
                 else:
                     if outgoing is None:
                         try:
@@ -282,4 +353,7 @@ class SerialConnection(threading.Thread):
         except (serial.SerialException, OSError) as e:
             log.error("serial.error: %s", e.args)
         finally:
+            self._close_selector()
+            if self._serial_port is not None:
+                self._serial_port.close()
             self._disconnected()
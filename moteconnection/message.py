@@ -2,7 +2,6 @@
 
 import logging
 import struct
-from codecs import encode
 
 from moteconnection.connection import Dispatcher
 from moteconnection.packet import Packet
@@ -17,94 +16,117 @@ AM_BROADCAST_ADDR = 0xFFFF
 
 
 class Message(Packet):
+    __slots__ = ("_type", "_destination", "_source", "_group", "_set_flags", "_footer", "_lqi", "_rssi")
+
     STRUCT_FORMAT_STRING = "! B H H B B B"
-    STRUCT_FORMAT_SIZE = struct.calcsize(STRUCT_FORMAT_STRING)
+    STRUCT = struct.Struct(STRUCT_FORMAT_STRING)
+    STRUCT_FORMAT_SIZE = STRUCT.size
+    FOOTER_STRUCT = struct.Struct("! B b")  # lqi, rssi
+    FOOTER_SIZE = FOOTER_STRUCT.size
+    # Bound once, saves an attribute lookup per message
+    _pack = STRUCT.pack
+    _unpack_from = STRUCT.unpack_from
+    _unpack_footer = FOOTER_STRUCT.unpack
+
+    # Bits of _set_flags
+    SOURCE_SET = 0x01
+    GROUP_SET = 0x02
 
     def __init__(self, ptype=0, destination=None, payload=b""):
-        """ Fields are initialized to None to detect if the user has set them
+        """ Fields default to 0, _set_flags records if the user has set the source and group
         or they should be set by a messaging layer to a default value."""
         super(Message, self).__init__(dispatch=0)
-        self._type = ptype
-        self._destination = destination
-        self._source = None
-        self._group = None
+        self._type = ptype or 0
+        self._destination = destination or 0
+        self._source = 0
+        self._group = 0
+        self._set_flags = 0
         self._payload = payload
         self._footer = b""
+        self._lqi = 0
+        self._rssi = 0
 
     @property
     def group(self):
-        if self._group is None:
-            return 0
         return self._group
 
     @group.setter
     def group(self, group):
-        self._group = group
+        if group is None:  # Leave it to the messaging layer
+            self._group = 0
+            self._set_flags &= ~Message.GROUP_SET
+        else:
+            self._group = group
+            self._set_flags |= Message.GROUP_SET
 
     @property
     def destination(self):
-        if self._destination is None:
-            return 0
         return self._destination
 
     @destination.setter
     def destination(self, destination):
-        self._destination = destination
+        self._destination = destination or 0  # None has always meant 0
 
     @property
     def source(self):
-        if self._source is None:
-            return 0
         return self._source
 
     @source.setter
     def source(self, source):
-        self._source = source
+        if source is None:  # Leave it to the messaging layer
+            self._source = 0
+            self._set_flags &= ~Message.SOURCE_SET
+        else:
+            self._source = source
+            self._set_flags |= Message.SOURCE_SET
 
     @property
     def type(self):
-        if self._type is None:
-            return 0
         return self._type
 
     @type.setter
     def type(self, ptype):
-        self._type = ptype
+        self._type = ptype or 0  # None has always meant 0
 
     @property
     def lqi(self):
-        if len(self._footer) == 2:
-            return struct.unpack('B', self._footer[0:1])[0]
-        return 0
+        return self._lqi
 
     @property
     def rssi(self):
-        if len(self._footer) == 2:
-            return struct.unpack('b', self._footer[1:2])[0]
-        return 0
+        return self._rssi
 
     def __str__(self):
-        return "{{{0.group:02X}}}{0.source:04X}->{0.destination:04X}[{0.type:02X}]{1:3d}: {2}".format(
-            self, len(self._payload), encode(self._payload, "hex").decode().upper())
+        return "{{{0._group:02X}}}{0._source:04X}->{0._destination:04X}[{0._type:02X}]{1:3d}: {2}".format(
+            self, len(self._payload), self._payload.hex().upper())
 
     def serialize(self):
-        return struct.pack(Message.STRUCT_FORMAT_STRING, self.dispatch, self.destination, self.source,
-                           len(self._payload), self.group, self.type) + self._payload + self._footer
+        return Message._pack(self._dispatch, self._destination, self._source,
+                             len(self._payload), self._group, self._type) + self._payload + self._footer
 
     @staticmethod
     def deserialize(data):
-        m = Message()
-        try:
-            m._dispatch, m._destination, m._source, length, m._group, m._type = struct.unpack(
-                Message.STRUCT_FORMAT_STRING, data[:Message.STRUCT_FORMAT_SIZE])
-            rest = data[Message.STRUCT_FORMAT_SIZE:]
-            if length <= len(rest):
-                m._payload = rest[:length]
-                m._footer = rest[length:]
-            else:
-                raise ValueError("Message payload length > actual length {} > {}".format(length, len(rest)))
-        except struct.error as e:
-            raise ValueError("Message unpacking error: {}".format(e.args))
+        m = Message.__new__(Message)  # Fields come from data, skip the defaults of __init__
+        m.callback = None
+        m._set_flags = Message.SOURCE_SET | Message.GROUP_SET
+        m._footer = b""
+        m._lqi = 0
+        m._rssi = 0
+        # Checked up front so that unpacking can not fail
+        if len(data) < Message.STRUCT_FORMAT_SIZE:
+            raise ValueError("Message header length < {} bytes: {}".format(Message.STRUCT_FORMAT_SIZE, len(data)))
+
+        m._dispatch, m._destination, m._source, length, m._group, m._type = Message._unpack_from(data)
+        # Payload and footer are sliced straight out of data, without copying the rest of it first
+        end = Message.STRUCT_FORMAT_SIZE + length
+        if end <= len(data):
+            m._payload = data[Message.STRUCT_FORMAT_SIZE:end]
+            m._footer = data[end:]
+            if len(m._footer) == Message.FOOTER_SIZE:
+                m._lqi, m._rssi = Message._unpack_footer(m._footer)
+        else:
+            raise ValueError("Message payload length > actual length {} > {}".format(
+                length, len(data) - Message.STRUCT_FORMAT_SIZE))
 
         return m
 
@@ -114,10 +136,12 @@ class MessageDispatcher(Dispatcher):
     def __init__(self, address=0x0001, group=0x22, dispatch=0):
         super(MessageDispatcher, self).__init__(dispatch)
         self._address = address
+        self._own_addresses = frozenset((address, 0, AM_BROADCAST_ADDR))
         self._group = group
-        self._receivers = {}
+        # Indexed by the message type
+        self._receivers = [None] * 256
         self._default_receiver = None
-        self._snoopers = {}
+        self._snoopers = [None] * 256
         self._default_snooper = None
 
     @property
@@ -125,38 +149,39 @@ class MessageDispatcher(Dispatcher):
         return self._address
 
     def send(self, message):
-        if message._source is None:
-            message._source = self._address
-        if message._group is None:
-            message._group = self._group
+        if not message._set_flags & Message.SOURCE_SET:
+            message.source = self._address
+        if not message._set_flags & Message.GROUP_SET:
+            message.group = self._group
 
         self._sender(message)
 
+    @staticmethod
+    def _check_type(ptype):
+        if not 0 <= ptype <= 0xFF:
+            raise ValueError("Message type {} out of range".format(ptype))
+
     def register_receiver(self, ptype, receiver):
-        if receiver is None and ptype in self._receivers:
-            del self._receivers[ptype]
-        else:
-            self._receivers[ptype] = receiver
+        self._check_type(ptype)
+        self._receivers[ptype] = self._delivery(receiver)
 
     def deregister_receiver(self, ptype, receiver):
-        if ptype in self._receivers:
-            if self._receivers[ptype] == receiver:
-                del self._receivers[ptype]
+        self._check_type(ptype)
+        if self._receivers[ptype] == self._delivery(receiver):
+            self._receivers[ptype] = None
 
     def register_default_receiver(self, receiver):
-        self._default_receiver = receiver
+        self._default_receiver = self._delivery(receiver)
 
     def deregister_default_receiver(self, receiver):
         self._default_receiver = None
 
     def register_snooper(self, ptype, snooper):
-        if snooper is None and ptype in self._snoopers:
-            del self._snoopers[ptype]
-        else:
-            self._snoopers[ptype] = snooper
+        self._check_type(ptype)
+        self._snoopers[ptype] = self._delivery(snooper)
 
     def register_default_snooper(self, snooper):
-        self._default_snooper = snooper
+        self._default_snooper = self._delivery(snooper)
 
     def deregister_default_snooper(self, snooper):
         self._default_snooper = None
@@ -164,15 +189,16 @@ class MessageDispatcher(Dispatcher):
     def receive(self, data):
         try:
             m = Message.deserialize(data)
-            if m.destination in (self._address, 0, AM_BROADCAST_ADDR):
-                if m.type in self._receivers:
-                    self._deliver(self._receivers[m.type], m)
-                elif self._default_receiver is not None:
-                    self._deliver(self._default_receiver, m)
+            if m._destination in self._own_addresses:
+                receiver = self._receivers[m._type]
+                if receiver is None:
+                    receiver = self._default_receiver
             else:
-                if m.type in self._snoopers:
-                    self._deliver(self._snoopers[m.type], m)
-                elif self._default_snooper is not None:
-                    self._deliver(self._default_snooper, m)
+                receiver = self._snoopers[m._type]
+                if receiver is None:
+                    receiver = self._default_snooper
+            if receiver is not None:
+                receiver(m)
         except ValueError as e:
-            log.warning("Failed to deserialize message {}: {}".format(data.encode("hex").upper(), e.args[0]))
+            if log.isEnabledFor(logging.WARNING):
+                log.warning("Failed to deserialize message %s: %s", data.hex().upper(), e.args[0])
@@ -2,7 +2,6 @@
 
 import logging
 import struct
-from codecs import encode
 
 from moteconnection.connection import Dispatcher
 
@@ -14,6 +13,7 @@ __license__ = "MIT"
 
 
 class Packet(object):
+    __slots__ = ("_dispatch", "_payload", "callback")
 
     def __init__(self, dispatch=0):
         self._dispatch = dispatch
@@ -40,7 +40,7 @@ class Packet(object):
         return struct.pack("! B", self._dispatch) + self._payload
 
     def __str__(self):
-        return "[{0._dispatch:02X}]{1:s}".format(self, encode(self._payload, "hex").upper())
+        return "[{0._dispatch:02X}]{1:s}".format(self, self._payload.hex().upper())
 
     @staticmethod
     def deserialize(data):
@@ -62,12 +62,13 @@ class PacketDispatcher(Dispatcher):
         self._sender(packet)
 
     def register_receiver(self, receiver):
-        self._receiver = receiver
+        self._receiver = self._delivery(receiver)
 
     def receive(self, data):
         try:
             p = Packet.deserialize(data)
             if self._receiver is not None:
-                self._deliver(self._receiver, p)
+                self._receiver(p)
         except ValueError:
-            log.warning("Failed to deserialize packet {}".format(encode(data, "hex").upper()))
+            if log.isEnabledFor(logging.WARNING):
+                log.warning("Failed to deserialize packet %s", data.hex().upper())
@@ -1,57 +1,72 @@
 """serial_ports.py: Serial port discovery functions."""
 
-from __future__ import print_function
-
+import fnmatch
 import glob
 import os
-import re
 import sys
+import time
 
-import serial
 import serial.tools.list_ports
 
 __author__ = "Raido Pahtma"
 __license__ = "MIT"
 
 
-def _list_windows_serial_ports():
-    ports = []
-
-    for port in serial.tools.list_ports.comports():
-        try:
-            s = serial.Serial(port.device)
-            ports.append(s.portstr)
-            s.close()
-        except serial.SerialException as e:
-            msg = e.args[0].lower()
-            if msg.find("could not open port") != -1 and msg.find("access is denied") != -1:
-                match = re.match(r"could not open port '(\w+)'", msg)
-                if match is not None:
-                    ports.append(match.group(1).upper())
+UNIX_SERIAL_PORT_PREFIXES = ("ttyUSB", "ttyAMA", "ttyMI")
 
-    return ports
+PORT_CACHE_TTL = 1.0  # seconds, 0 disables caching
 
+_port_cache = {}
 
-def _list_unix_serial_ports(additional=None):
-    ports = []
 
-    port_list = glob.glob('/dev/ttyUSB*') + glob.glob('/dev/ttyAMA*') + glob.glob('/dev/ttyMI*')
+def _list_windows_serial_ports():
+    # comports lists ports that are in use as well, no need to open them
+    return [port.device for port in serial.tools.list_ports.comports()]
+
+
+def _list_unix_serial_ports(additional=None):
+    # One pass over /dev, glob would read the directory once per pattern
+    try:
+        names = [entry.name for entry in os.scandir("/dev")]
+        ports = ["/dev/" + name for name in names if name.startswith(UNIX_SERIAL_PORT_PREFIXES)]
+    except OSError:
+        names = None  # No /dev or not allowed to list it, glob found nothing in that case either
+        ports = []
 
     if additional is not None:
         for location in additional:
-            port_list += glob.glob(location)
-
-    for port in port_list:
-        if os.path.exists(port):
-            ports.append(port)
+            directory, pattern = os.path.split(location)
+            if names is not None and directory == "/dev" and not pattern.startswith("."):
+                # Like glob, hidden names are only matched by patterns starting with a dot
+                ports += ["/dev/" + name for name in fnmatch.filter(names, pattern) if not name.startswith(".")]
+            else:
+                ports += glob.glob(location)
 
     return ports
 
 
 def list_serial_ports(additional=None):
+    """
+    Results are reused for PORT_CACHE_TTL seconds, list_serial_ports.cache_clear() forces a new scan.
+    :param additional: Optional list of extra glob patterns, ignored on Windows.
+    :return: List of serial port names.
+    """
+    key = tuple(additional or ())
+    now = time.monotonic()
+    cached = _port_cache.get(key)
+    if cached is not None and now - cached[0] < PORT_CACHE_TTL:
+        return list(cached[1])
+
     if sys.platform == "win32":
-        return _list_windows_serial_ports()
-    return _list_unix_serial_ports(additional)
+        ports = _list_windows_serial_ports()
+    else:
+        ports = _list_unix_serial_ports(additional)
+
+    _port_cache[key] = (now, ports)
+    return list(ports)
+
+
+list_serial_ports.cache_clear = _port_cache.clear
 
 
 if __name__ == "__main__":
@@ -1,8 +1,59 @@
-import codecs
+from contextlib import contextmanager
 from unittest import TestCase
+import queue
+import socket
+import threading
 
 import mock
-import six
+
+from moteconnection.connection import Connection
+from moteconnection.connection_forwarder import SfConnection
+from moteconnection.packet import Packet, PacketDispatcher
+
+
+@contextmanager
+def sf_server(rcvbuf=None):
+    """Listening socket standing in for a serial forwarder."""
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if rcvbuf is not None:
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    server.settimeout(1)
+    try:
+        yield server
+    finally:
+        server.close()
+
+
+@contextmanager
+def get_connection(server, receiver=None, disconnected=None, suffix=''):
+    connection = Connection()
+    dispatcher = PacketDispatcher(0x0E)
+    dispatcher.register_receiver(receiver)
+    connection.register_dispatcher(dispatcher)
+    connection.connect('sf@127.0.0.1:{}{}'.format(server.getsockname()[1], suffix), disconnected=disconnected)
+
+    client, _ = server.accept()
+    client.settimeout(1)
+    try:
+        assert client.recv(2) == b'U '
+        client.sendall(b'U ')
+        connection._connected.wait(timeout=1)
+        yield connection, client
+    finally:
+        connection.disconnect()
+        connection.join()
+        client.close()
+
+
+class ConnectionStringTester(TestCase):
+    def test_extra_separator(self):
+        """
+        Tests that anything after a second separator in the address is ignored.
+        """
+        with sf_server() as server, get_connection(server, suffix=':x') as (connection, client):
+            self.assertTrue(connection.connected())
 
 
 class IncomingPacketTester(TestCase):
@@ -10,7 +61,22 @@ class IncomingPacketTester(TestCase):
         """
         Tests the handling of incoming serial forwarder packets.
         """
-        pass
+        receive_queue = queue.Queue()
+        with sf_server() as server, get_connection(server, receive_queue) as (connection, client):
+            # Two frames in one segment, then a frame split over two segments
+            client.sendall(b'\x03\x0E\x01\x02\x02\x0E\x03\x03\x0E')
+            client.sendall(b'\x7E\x7D')
+
+            payloads = []
+            for i in range(3):
+                try:
+                    packet = receive_queue.get(timeout=1)
+                except queue.Empty:
+                    self.fail('Did not receive enough packets ({})'.format(i))
+                self.assertEqual(packet.dispatch, 0x0E)
+                payloads.append(packet.payload)
+
+        self.assertEqual(payloads, [b'\x01\x02', b'\x03', b'\x7E\x7D'])
 
 
 class OutgoingPacketTester(TestCase):
@@ -18,4 +84,52 @@ class OutgoingPacketTester(TestCase):
         """
         Tests the handling of outgoing serial forwarder packets.
         """
-        pass
+        with sf_server() as server, get_connection(server) as (connection, client):
+            packet = Packet(0x0E)
+            packet.payload = b'\x01\x02\x03'
+            connection.send(packet)
+
+            expected = b'\x04\x0E\x01\x02\x03'
+            data = b''
+            while len(data) < len(expected):
+                data += client.recv(len(expected) - len(data))
+
+        self.assertEqual(data, expected)
+
+    def test_outgoing_packet_too_long(self):
+        """
+        Tests that a packet that does not fit a length byte is dropped and the connection keeps working.
+        """
+        acks = queue.Queue()
+        with sf_server() as server, get_connection(server) as (connection, client):
+            packet = Packet(0x0E)
+            packet.payload = b'\x00' * 255
+            packet.callback = lambda p, acked: acks.put(acked)
+            connection.send(packet)
+            self.assertFalse(acks.get(timeout=1))
+
+            packet = Packet(0x0E)
+            packet.payload = b'\x01'
+            connection.send(packet)
+
+            expected = b'\x02\x0E\x01'
+            data = b''
+            while len(data) < len(expected):
+                data += client.recv(len(expected) - len(data))
+
+        self.assertEqual(data, expected)
+
+    def test_outgoing_peer_not_reading(self):
+        """
+        Tests that a peer that stops reading gets the connection disconnected instead of blocking sends.
+        """
+        disconnected = threading.Event()
+        with mock.patch.object(SfConnection, 'SOCKET_SNDBUF', 4096), \
+                mock.patch.object(SfConnection, 'SEND_TIMEOUT', 0.1), \
+                sf_server(rcvbuf=4096) as server, \
+                get_connection(server, disconnected=disconnected.set) as (connection, client):
+            for _ in range(2000):
+                packet = Packet(0x0E)
+                packet.payload = b'\x00' * 100
+                connection.send(packet)
+            self.assertTrue(disconnected.wait(timeout=5))
@@ -0,0 +1,39 @@
+from unittest import TestCase
+import queue
+
+from moteconnection.connection import Connection
+from moteconnection.packet import Packet, PacketDispatcher
+
+
+class LoopbackPacketTester(TestCase):
+    """Test packets sent over a loopback connection."""
+
+    def test_loopback_packet(self):
+        """
+        Tests that a sent packet is received by the same connection and acked.
+        """
+        receive_queue = queue.Queue()
+        acks = queue.Queue()
+
+        connection = Connection()
+        dispatcher = PacketDispatcher(0x0E)
+        dispatcher.register_receiver(receive_queue)
+        connection.register_dispatcher(dispatcher)
+        connection.connect('loopback@')
+        connection._connected.wait(timeout=1)
+        try:
+            packet = Packet()
+            packet.payload = b'\x01\x02\x03'
+            packet.callback = lambda p, acked: acks.put(acked)
+            dispatcher.send(packet)
+
+            try:
+                received = receive_queue.get(timeout=1)
+            except queue.Empty:
+                self.fail('Did not receive the packet')
+            self.assertEqual(received.dispatch, 0x0E)
+            self.assertEqual(received.payload, b'\x01\x02\x03')
+            self.assertTrue(acks.get(timeout=1))
+        finally:
+            connection.disconnect()
+            connection.join()
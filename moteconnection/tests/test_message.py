@@ -1,7 +1,7 @@
 import codecs
 from unittest import TestCase
 
-from moteconnection.message import Message
+from moteconnection.message import Message, MessageDispatcher
 
 
 class MessageConversionTester(TestCase):
@@ -16,3 +16,66 @@ class MessageConversionTester(TestCase):
     def test_new_format(self):
         result = '{!s}'.format(self.message)
         self.assertEqual(result, self.expected)
+
+
+class MessageSerializationTester(TestCase):
+    def test_serialize(self):
+        message = Message(ptype=0xF0, destination=0x0015, payload=b'\x12\xAB')
+        message.source = 0x0102
+        message.group = 0x22
+        self.assertEqual(message.serialize(), b'\x00\x00\x15\x01\x02\x02\x22\xF0\x12\xAB')
+
+    def test_serialize_unset_fields(self):
+        message = Message(ptype=0xF0, destination=0x0015)
+        message.destination = None
+        message.type = None
+        self.assertEqual(message.serialize(), b'\x00\x00\x00\x00\x00\x00\x00\x00')
+
+    def test_deserialize(self):
+        message = Message.deserialize(b'\x00\x00\x15\x01\x02\x02\x22\xF0\x12\xAB\x30\xD8')
+        self.assertEqual(message.destination, 0x0015)
+        self.assertEqual(message.source, 0x0102)
+        self.assertEqual(message.group, 0x22)
+        self.assertEqual(message.type, 0xF0)
+        self.assertEqual(message.payload, b'\x12\xAB')
+        self.assertEqual(message.lqi, 0x30)
+        self.assertEqual(message.rssi, -40)
+
+    def test_deserialize_errors(self):
+        with self.assertRaises(ValueError):
+            Message.deserialize(b'\x00\x00\x15')
+        with self.assertRaises(ValueError):
+            Message.deserialize(b'\x00\x00\x15\x01\x02\x05\x22\xF0\x12\xAB')
+
+
+class MessageDispatcherTester(TestCase):
+    def setUp(self):
+        self.dispatcher = MessageDispatcher(address=0x0015)
+        self.received = []
+
+    def deliver(self, name):
+        return lambda m: self.received.append((name, m.destination, m.type))
+
+    def test_receive(self):
+        self.dispatcher.register_receiver(0xF0, self.deliver('receiver'))
+        self.dispatcher.register_default_receiver(self.deliver('default'))
+        self.dispatcher.register_default_snooper(self.deliver('snooper'))
+
+        self.dispatcher.receive(b'\x00\x00\x15\x01\x02\x00\x22\xF0')
+        self.dispatcher.receive(b'\x00\xFF\xFF\x01\x02\x00\x22\xF1')
+        self.dispatcher.receive(b'\x00\x00\x16\x01\x02\x00\x22\xF0')
+        self.assertEqual(self.received, [('receiver', 0x0015, 0xF0),
+                                         ('default', 0xFFFF, 0xF1),
+                                         ('snooper', 0x0016, 0xF0)])
+
+    def test_send_defaults(self):
+        sent = []
+        self.dispatcher.attach(sent.append)
+
+        self.dispatcher.send(Message(ptype=0xF0, destination=0x0016))
+        message = Message(ptype=0xF0, destination=0x0016)
+        message.source = 0x0102
+        message.group = 0
+        self.dispatcher.send(message)
+
+        self.assertEqual([(m.source, m.group) for m in sent], [(0x0015, 0x22), (0x0102, 0)])
@@ -1,20 +1,38 @@
 import codecs
 from contextlib import contextmanager
-from unittest import TestCase
+from unittest import TestCase, skipUnless
+import os
+import queue
+import select
+import selectors
+import struct
 import time
 
 import mock
-from six.moves import queue
 
 from moteconnection.connection import Connection
+from moteconnection.connection_serial import itut_g16_crc
 from moteconnection.packet import Packet, PacketDispatcher
 
 
+class CrcTester(TestCase):
+    """Test the serial frame checksum."""
+    def test_itut_g16_crc(self):
+        """
+        Tests the CRC against the CRC-CCITT (XMODEM) check value and known frames.
+        """
+        self.assertEqual(itut_g16_crc(b''), 0x0000)
+        self.assertEqual(itut_g16_crc(b'123456789'), 0x31C3)
+        self.assertEqual(itut_g16_crc(b'\x44\x00\xFF'), 0xDF9D)
+        self.assertEqual(itut_g16_crc(b'\x44\x00\x0E\x7E\x7E\x7E'), 0xB9ED)
+
+
 class IncomingPacketTester(TestCase):
     """Test incoming packet handling."""
     def setUp(self):
         serial_patch = mock.patch('moteconnection.connection_serial.serial.Serial')
         self.serial_mock = serial_patch.start()
+        self.serial_mock.return_value.in_waiting = 0
         self.addCleanup(serial_patch.stop)
 
     def test_incoming_ack_packet(self):
@@ -94,6 +112,39 @@ class IncomingPacketTester(TestCase):
         expected.payload = b'\x7D\x7E'
         compare(packet, expected)
 
+    def test_incoming_packets_in_one_read(self):
+        """
+        Tests several incoming packets arriving in one read and a packet split over reads.
+        """
+
+        def iterator(chunks):
+            for chunk in chunks:
+                yield chunk
+            while 1:
+                yield b''
+
+        self.serial_mock.return_value.read.side_effect = iterator([
+            b'\x7E\x44\x01\x0E\x01\x02\xA8\xE6\x7E\x7E\x44\x02\x0E\x7D',
+            b'\x5D\x7D\x5E\x0A\x2D\x9A\x7E'])
+        receive_queue = queue.Queue()
+        connection = Connection()
+        dispatcher = PacketDispatcher(0x0E)
+        dispatcher.register_receiver(receive_queue)
+        connection.register_dispatcher(dispatcher)
+        connection.connect('serial@/dev/fake:123456789')
+        try:
+            payloads = []
+            for i in range(2):
+                try:
+                    payloads.append(receive_queue.get(timeout=1).payload)
+                except queue.Empty:
+                    self.fail('Did not receive enough packets ({})'.format(i))
+        finally:
+            connection.disconnect()
+            connection.join()
+
+        self.assertEqual(payloads, [b'\x01\x02', b'\x7D\x7E\x0A'])
+
     def test_incoming_noack_packet(self):
         """
         Tests the incoming noack packets over serial.
@@ -106,6 +157,7 @@ class OutgoingPacketTester(TestCase):
     def setUp(self):
         serial_patch = mock.patch('moteconnection.connection_serial.serial.Serial')
         self.serial_mock = serial_patch.start()
+        self.serial_mock.return_value.in_waiting = 0
         self.addCleanup(serial_patch.stop)
 
     def test_outgoing_ack_packet(self):
@@ -177,3 +229,105 @@ class OutgoingPacketTester(TestCase):
         Tests the outgoing noack packets over serial.
         """
         pass
+
+
+@skipUnless(hasattr(os, 'openpty'), 'needs a pseudo terminal')
+class PseudoTerminalTester(TestCase):
+    """Test a serial port that is waited on with a selector instead of polled."""
+    def setUp(self):
+        import tty
+        self.master, slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(slave)
+        self.port = os.ttyname(slave)
+        self.addCleanup(os.close, self.master)
+        self.addCleanup(os.close, slave)
+
+    def test_incoming_and_outgoing_packet(self):
+        """
+        Tests that a received packet is acked and an outgoing packet is written without polling.
+        """
+        receive_queue = queue.Queue()
+        connection = Connection()
+        dispatcher = PacketDispatcher(0x0E)
+        dispatcher.register_receiver(receive_queue)
+        connection.register_dispatcher(dispatcher)
+        connection.connect('serial@{}:115200'.format(self.port))
+        connection._connected.wait(timeout=1)
+        try:
+            os.write(self.master, b'\x7E\x44\x01\x0E\x01\x02\xA8\xE6\x7E')
+            try:
+                packet = receive_queue.get(timeout=1)
+            except queue.Empty:
+                self.fail('Did not receive the packet')
+            self.assertEqual(packet.payload, b'\x01\x02')
+            self.assertEqual(os.read(self.master, 6), b'\x7E\x43\x01\xBE\x48\x7E')
+
+            packet = Packet(0x0E)
+            packet.payload = b'\x7D\x7E'
+            connection.send(packet)
+            self.assertEqual(os.read(self.master, 11), b'\x7E\x44\x00\x0E\x7D\x5D\x7D\x5E\x33\x62\x7E')
+        finally:
+            connection.disconnect()
+            connection.join()
+
+    @contextmanager
+    def get_connection(self, acks):
+        connection = Connection()
+        connection.register_dispatcher(PacketDispatcher(0x0E))
+        connection.connect('serial@{}:115200*{}'.format(self.port, acks))
+        connection._connected.wait(timeout=1)
+        try:
+            yield connection
+        finally:
+            connection.disconnect()
+            connection.join()
+
+    def read_frame(self):
+        data = b''
+        while data.count(b'\x7E') < 2:
+            ready, _, _ = select.select([self.master], [], [], 1)
+            if not ready:
+                self.fail('Did not receive a frame after {!r}'.format(data))
+            data += os.read(self.master, 1)
+        return data
+
+    def send_burst(self, connection, count):
+        for i in range(count):
+            packet = Packet(0x0E)
+            packet.payload = bytes((i,))
+            connection.send(packet)
+
+    def test_outgoing_noack_burst(self):
+        """
+        Tests that all packets sent in a burst are written.
+        """
+        with self.get_connection('NOACK') as connection:
+            self.send_burst(connection, 3)
+            frames = [self.read_frame() for _ in range(3)]
+        self.assertEqual([frame[1:-3] for frame in frames], [b'\x45\x0E\x00', b'\x45\x0E\x01', b'\x45\x0E\x02'])
+
+    def test_outgoing_ack_burst(self):
+        """
+        Tests that packets sent in a burst are written one after another as the previous one is acked.
+        """
+        with self.get_connection('ACK') as connection:
+            self.send_burst(connection, 3)
+            frames = []
+            for _ in range(3):
+                frame = self.read_frame()
+                frames.append(frame[1:-3])
+                ack = bytes((0x43, frame[2]))
+                os.write(self.master, b'\x7E' + ack + struct.pack('<H', itut_g16_crc(ack)) + b'\x7E')
+        self.assertEqual(frames, [b'\x44\x00\x0E\x00', b'\x44\x01\x0E\x01', b'\x44\x02\x0E\x02'])
+
+    def test_outgoing_burst_unselectable_port(self):
+        """
+        Tests that a port the selector does not support falls back to polling reads.
+        """
+        with mock.patch.object(selectors.SelectSelector, 'register', side_effect=OSError(22, 'Invalid argument')):
+            with self.get_connection('NOACK') as connection:
+                self.assertIsNone(connection._real_connection._selector)
+                self.send_burst(connection, 3)
+                frames = [self.read_frame() for _ in range(3)]
+        self.assertEqual([frame[1:-3] for frame in frames], [b'\x45\x0E\x00', b'\x45\x0E\x01', b'\x45\x0E\x02'])
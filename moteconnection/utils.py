@@ -6,7 +6,5 @@ __license__ = "MIT"
 
 
 def split_in_two(text, separator):
-    parts = text.split(separator)
-    if len(parts) == 1:
-        return parts[0], ""
-    return parts[0], parts[1]
+    head, _, tail = text.partition(separator)
+    return head, tail.partition(separator)[0]  # Anything after a second separator is dropped
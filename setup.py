@@ -20,7 +20,8 @@ setup(name='moteconnection',
       author_email='raido.pahtma@ttu.ee',
       license='MIT',
       platforms=["any"],
-      install_requires=["pyserial", "six"],
+      python_requires=">=3.5",
+      install_requires=["pyserial"],
       tests_required=['nose', 'mock'],
       packages=['moteconnection'],
       zip_safe=False)